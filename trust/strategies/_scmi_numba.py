@@ -0,0 +1,140 @@
+import heapq
+import numpy as np
+
+from numba import njit, prange
+from scipy import sparse
+
+# Facility Location Conditional Mutual Information (FLCMI) is
+#
+#     I(A; Q | P) = sum_i max(min(max_{j in A} s_ij, eta * max_{q in Q} s_iq) - nu * max_{p in P} s_ip, 0)
+#
+# For each ground element i, t_i(x) = max(min(x, eta * qmax_i) - nu * pmax_i, 0) is non-decreasing in x, so
+# t_i(max_{j in A} s_ij) = max_{j in A} t_i(s_ij). Applying t once to the kernel therefore reduces FLCMI to plain
+# facility location over the transformed kernel, whose greedy only needs a running per-element coverage vector.
+# This transform is also where eta and nu are partially evaluated: they are folded into the kernel in one O(n^2) pass,
+# so the O(n * budget) greedy loop never touches them and needs no per-(eta, nu) specialization. The compiled greedy
+# only depends on array types and is cached on disk, so its compilation is paid once rather than in every process.
+# Kernels are stored candidate-major (row j holds t_i(s_ij) for all i) so that each marginal gain reads one
+# contiguous row. A sparse kernel is stored the same way in CSR form, with missing entries meaning s_ij = 0.
+
+@njit(fastmath=True, cache=True)
+def _gain(j, dense, values, indices, indptr, current):
+    gain = 0.0
+    if indptr.shape[0] == 0:
+        # A single branch-free pass over the contiguous candidate row without temporaries; with fastmath, the
+        # compare/select and the reduction vectorize to packed max/add instructions.
+        row = dense[j]
+        for i in range(row.shape[0]):
+            v = row[i]
+            m = current[i]
+            gain += v - m if v > m else 0.0
+        return gain
+
+    for k in range(indptr[j], indptr[j + 1]):
+        gain += max(values[k] - current[indices[k]], 0.0)
+    return gain
+
+@njit(cache=True)
+def _update(j, dense, values, indices, indptr, current):
+    if indptr.shape[0] == 0:
+        np.maximum(current, dense[j], current)
+    else:
+        for k in range(indptr[j], indptr[j + 1]):
+            current[indices[k]] = max(current[indices[k]], values[k])
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _initial_gains(n, dense, values, indices, indptr, current):
+    gains = np.empty(n)
+    for j in prange(n):
+        gains[j] = _gain(j, dense, values, indices, indptr, current)
+    return gains
+
+@njit(cache=True)
+def _lazy_greedy(n, dense, values, indices, indptr, current, budget, stop_if_zero_gain):
+
+    # Max-heap of upper bounds on the marginal gains; ties are broken towards the larger index, as in submodlib's
+    # NaiveGreedy and LazyGreedy
+    gains = _initial_gains(n, dense, values, indices, indptr, current)
+    heap = [(-gains[j], -j) for j in range(n)]
+    heapq.heapify(heap)
+
+    selected = np.empty(budget, dtype=np.int64)
+    selected_gains = np.empty(budget)
+    count = 0
+
+    while count < budget and len(heap) > 0:
+
+        # By submodularity, a stale bound can only overestimate the gain. If the refreshed gain still beats
+        # every other bound (or ties it with no larger index waiting), it is the true maximum; otherwise, push it
+        # back with the tighter bound.
+        _, neg_j = heapq.heappop(heap)
+        j = -neg_j
+        gain = _gain(j, dense, values, indices, indptr, current)
+        if len(heap) > 0 and (gain < -heap[0][0] or (gain == -heap[0][0] and -heap[0][1] > j)):
+            heapq.heappush(heap, (-gain, neg_j))
+            continue
+
+        if stop_if_zero_gain and gain <= 0:
+            break
+
+        _update(j, dense, values, indices, indptr, current)
+        selected[count] = j
+        selected_gains[count] = gain
+        count += 1
+
+    return selected[:count], selected_gains[:count]
+
+def flcmi_greedy(data_sijs, query_sijs, private_sijs, budget, eta=1, nu=1, stop_if_zero_gain=False):
+    """
+    Maximizes FLCMI with the lazy greedy algorithm, which returns the same selection as the naive greedy algorithm up
+    to ties; ties are broken towards the larger index, as in submodlib. This bypasses the per-oracle-call overhead of submodlib's maximize() for the most common SCMI function.
+
+    Parameters
+    ----------
+    data_sijs: numpy.ndarray or scipy.sparse.csr_matrix
+        The symmetric (n, n) unlabeled-unlabeled similarity kernel, or a sparse kernel whose row i holds the
+        similarities of element i to its nearest neighbors. A float32 ndarray is overwritten with the transformed kernel.
+    query_sijs: numpy.ndarray
+        The (n, num_queries) unlabeled-query similarity kernel
+    private_sijs: numpy.ndarray
+        The (n, num_privates) unlabeled-private similarity kernel
+    budget: int
+        The number of elements to select
+    eta: float
+        The query magnification constant
+    nu: float
+        The privacy hardness constant
+    stop_if_zero_gain: bool
+        Stops the maximization early once the best marginal gain is zero
+
+    Returns
+    ----------
+    greedyList: list
+        List of (index, marginal gain) tuples in selection order, as returned by submodlib's maximize()
+    """
+
+    n = query_sijs.shape[0]
+    lower = (nu * private_sijs.max(axis=1)).astype(np.float32)
+    upper = (eta * query_sijs.max(axis=1)).astype(np.float32)
+
+    # Coverage of the empty set, for which the maximum similarity is taken to be zero
+    current = np.maximum(np.minimum(0, upper) - lower, 0).astype(np.float32)
+
+    if sparse.issparse(data_sijs):
+        kernel = data_sijs.T.tocsr()
+        values = np.maximum(np.minimum(kernel.data, upper[kernel.indices]) - lower[kernel.indices], 0).astype(np.float32)
+        indices = kernel.indices.astype(np.int64)
+        indptr = kernel.indptr.astype(np.int64)
+        dense = np.empty((0, 0), dtype=np.float32)
+    else:
+        # data_sijs is symmetric, so row j already holds s_ij for every i and only the transform is needed
+        dense = np.asarray(data_sijs, dtype=np.float32)
+        np.minimum(dense, upper[None, :], dense)
+        dense -= lower[None, :]
+        np.maximum(dense, 0, dense)
+        values = np.empty(0, dtype=np.float32)
+        indices = np.empty(0, dtype=np.int64)
+        indptr = np.empty(0, dtype=np.int64)
+
+    selected, gains = _lazy_greedy(n, dense, values, indices, indptr, current, min(budget, n), stop_if_zero_gain)
+    return [(int(j), float(gain)) for j, gain in zip(selected, gains)]
@@ -1,11 +1,243 @@
 from .strategy import Strategy
+import itertools
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from torch import nn
-from scipy import stats
+from scipy import stats, sparse
 import submodlib
 
+try:
+    from ._scmi_numba import flcmi_greedy
+except ImportError:
+    flcmi_greedy = None
+
+# Above this many (n * budget) oracle calls, auto_optimizer switches to LazierThanLazyGreedy
+_AUTO_OPTIMIZER_THRESHOLD = 5e7
+
+_KERNEL_DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+# Defaults for the args keys read by SCMI.select()
+_DEFAULT_ARGS = {'scmi_function': None, 'optimizer': 'LazyGreedy', 'metric': 'cosine', 'eta': 1, 'nu': 1, 'lambdaVal': 1, 
+                 'gradType': "bias_linear", 'stopIfZeroGain': False, 'stopIfNegativeGain': False, 'verbose': False, 
+                 'embedding_type': "gradients", 'layer_name': "avgpool", 'keep_embedding': False, 'auto_optimizer': False, 
+                 'epsilon': 0.1, 'kernel_dtype': "float32", 'kernel_sparsity_k': None, 'parallel_kernels': True}
+
+# Number of kernel rows materialized at a time when building a sparse nearest-neighbor kernel, or when sklearn fills 
+# a preallocated dense kernel
+_KERNEL_BLOCK_SIZE = 1024
+
+def _similarity(X, metric, X_rep=None, dtype=torch.float32):
+    """
+    Returns the (len(X_rep), len(X)) similarity kernel of two PyTorch tensors as a tensor on their device.
+    """
+    
+    if(metric == "cosine"):
+        # Normalize in the embedding precision, then run the GEMM in the requested (possibly half) precision
+        X_norm = nn.functional.normalize(X, dim=1).to(dtype)
+        X_rep_norm = X_norm if X_rep is None else nn.functional.normalize(X_rep, dim=1).to(dtype)
+        return X_rep_norm @ X_norm.T
+    elif(metric == "euclidean"):
+        # Same similarity transform as submodlib: exp(-d * gamma) with gamma = 1 / num_features
+        dist = torch.cdist(X if X_rep is None else X_rep, X)
+        return torch.exp(-dist / X.shape[1])
+    else:
+        raise ValueError("Provided metric must be one of cosine or euclidean")
+
+def _prepare_embeddings(X, metric, dtype=torch.float32):
+    """
+    Prepares embeddings for blockwise kernel computation with _similarity_block, so that each block of rows only costs 
+    a GEMM (plus the distance transform for euclidean). Cosine rows are normalized up front; for euclidean, the squared 
+    row norms are precomputed so that distances can be expanded as |a|^2 + |b|^2 - 2ab. NumPy arrays are cast to 
+    float32; dtype sets the precision of the cosine GEMM for PyTorch tensors.
+    
+    Returns
+    ----------
+    X: torch.Tensor or numpy.ndarray
+        The prepared embeddings
+    sq_norms: torch.Tensor or numpy.ndarray or None
+        The squared row norms for euclidean, None for cosine
+    """
+    
+    if(metric not in ("cosine", "euclidean")):
+        raise ValueError("Provided metric must be one of cosine or euclidean")
+    if isinstance(X, torch.Tensor):
+        if(metric == "cosine"):
+            return nn.functional.normalize(X, dim=1).to(dtype), None
+        return X, (X * X).sum(dim=1)
+    
+    X = np.asarray(X, dtype=np.float32)
+    if(metric == "cosine"):
+        norms = np.linalg.norm(X, axis=1, keepdims=True)
+        return X / np.where(norms == 0, 1, norms), None
+    return X, (X * X).sum(axis=1)
+
+def _similarity_block(X_rep, X, rep_sq_norms, sq_norms):
+    """
+    Returns the float32 (len(X_rep), len(X)) similarity block between embeddings prepared with _prepare_embeddings. 
+    Euclidean similarities use submodlib's exp(-d / num_features) transform.
+    """
+    
+    block = X_rep @ X.T
+    if isinstance(block, torch.Tensor):
+        if sq_norms is not None:
+            dist = torch.sqrt(torch.clamp(rep_sq_norms[:, None] + sq_norms[None, :] - 2 * block, min=0))
+            block = torch.exp(-dist / X.shape[1])
+        return block.float()
+    if sq_norms is not None:
+        dist = np.sqrt(np.maximum(rep_sq_norms[:, None] + sq_norms[None, :] - 2 * block, 0))
+        block = np.exp(-dist / X.shape[1])
+    return block
+
+def _create_kernel(X, metric, X_rep=None, dtype=torch.float32, out=None):
+    """
+    Computes a dense similarity kernel between the rows of X_rep and the rows of X. PyTorch tensors are handled with a 
+    normalized GEMM (cosine) or torch.cdist (euclidean) on their current device, which is considerably faster than 
+    sklearn's pairwise routines on a GPU. NumPy arrays are passed on to submodlib.helper.create_kernel. When out is 
+    given, both are instead computed blockwise with _similarity_block.
+    
+    Parameters
+    ----------
+    X: torch.Tensor or numpy.ndarray
+        The embeddings forming the columns of the kernel
+    metric: string
+        The similarity metric to use. This can be either 'cosine' or 'euclidean'
+    X_rep: torch.Tensor or numpy.ndarray, optional
+        The embeddings forming the rows of the kernel. If None, X is used.
+    dtype: torch.dtype, optional
+        The precision of the cosine GEMM for PyTorch tensors; ignored for NumPy arrays. The returned kernel is always 
+        float32 in the PyTorch case.
+    out: numpy.ndarray, optional
+        A float32 array (or view) of shape (len(X_rep), len(X)) to write the kernel into instead of allocating a new one. 
+        It is filled a block of rows at a time from embeddings prepared once up front, so that no second full-size kernel 
+        is ever held on the host or the device.
+    
+    Returns
+    ----------
+    kernel: numpy.ndarray
+        A (len(X_rep), len(X)) similarity kernel, computed in the same way as submodlib.helper.create_kernel
+    """
+    
+    if out is None:
+        if not isinstance(X, torch.Tensor):
+            return submodlib.helper.create_kernel(X=X, X_rep=X_rep, metric=metric, method="sklearn")
+        return _similarity(X, metric, X_rep=X_rep, dtype=dtype).float().cpu().numpy()
+    
+    # Prepare X once and fill out a block of rows at a time, so that neither sklearn nor the device ever holds a 
+    # second full-size kernel
+    X, sq_norms = _prepare_embeddings(X, metric, dtype)
+    if X_rep is None:
+        X_rep, rep_sq_norms = X, sq_norms
+    else:
+        X_rep, rep_sq_norms = _prepare_embeddings(X_rep, metric, dtype)
+    out_view = torch.from_numpy(out) if isinstance(X, torch.Tensor) else out
+    for start in range(0, X_rep.shape[0], _KERNEL_BLOCK_SIZE):
+        end = min(start + _KERNEL_BLOCK_SIZE, X_rep.shape[0])
+        block_sq_norms = None if rep_sq_norms is None else rep_sq_norms[start:end]
+        out_view[start:end] = _similarity_block(X_rep[start:end], X, block_sq_norms, sq_norms)
+    return out
+
+def _create_sparse_kernel(X, metric, num_neighbors, dtype=torch.float32):
+    """
+    Computes a sparse similarity kernel of X with itself that keeps only the num_neighbors largest similarities in 
+    each row. The dense kernel is never materialized as a whole; it is built and reduced a block of rows at a time, 
+    so memory is O(n * num_neighbors) instead of O(n^2). Missing entries are treated as zero similarity.
+    
+    Parameters
+    ----------
+    X: torch.Tensor or numpy.ndarray
+        The embeddings to compute the kernel over
+    metric: string
+        The similarity metric to use. This can be either 'cosine' or 'euclidean'
+    num_neighbors: int
+        The number of entries to keep in each row
+    dtype: torch.dtype, optional
+        The precision of the cosine GEMM for PyTorch tensors; ignored for NumPy arrays.
+    
+    Returns
+    ----------
+    kernel: scipy.sparse.csr_matrix
+        A (len(X), len(X)) sparse similarity kernel
+    """
+    
+    n = X.shape[0]
+    num_neighbors = min(num_neighbors, n)
+    values = np.empty((n, num_neighbors), dtype=np.float32)
+    indices = np.empty((n, num_neighbors), dtype=np.int64)
+    
+    X, sq_norms = _prepare_embeddings(X, metric, dtype)
+    for start in range(0, n, _KERNEL_BLOCK_SIZE):
+        end = min(start + _KERNEL_BLOCK_SIZE, n)
+        block_sq_norms = None if sq_norms is None else sq_norms[start:end]
+        block = _similarity_block(X[start:end], X, block_sq_norms, sq_norms)
+        if isinstance(block, torch.Tensor):
+            block_values, block_indices = torch.topk(block, num_neighbors, dim=1)
+            values[start:end] = block_values.cpu().numpy()
+            indices[start:end] = block_indices.cpu().numpy()
+        else:
+            block_indices = np.argpartition(-block, num_neighbors - 1, axis=1)[:, :num_neighbors]
+            values[start:end] = np.take_along_axis(block, block_indices, axis=1)
+            indices[start:end] = block_indices
+    
+    indptr = np.arange(0, n * num_neighbors + 1, num_neighbors)
+    return sparse.csr_matrix((values.ravel(), indices.ravel(), indptr), shape=(n, n))
+
+def _build_kernels(builders, parallel=True):
+    """
+    Runs a dict of independent, argument-free kernel builders and returns a dict of their results under the same keys. 
+    When parallel is True, the builders run concurrently on a thread pool; sklearn's pairwise routines and torch 
+    operations release the GIL, so the builds overlap across cores.
+    """
+    
+    if not parallel or len(builders) < 2:
+        return {name: builder() for name, builder in builders.items()}
+    
+    with ThreadPoolExecutor(max_workers=len(builders)) as executor:
+        futures = {name: executor.submit(builder) for name, builder in builders.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+def _build_flcmi(n, num_queries, num_privates, sijs, cfg):
+    
+    #FacilityLocationConditionalMutualInformationFunction only accepts dense kernels
+    data_sijs = sijs['data'].toarray() if sparse.issparse(sijs['data']) else sijs['data']
+    return submodlib.FacilityLocationConditionalMutualInformationFunction(n=n,
+                                                                          num_queries=num_queries,
+                                                                          num_privates=num_privates, 
+                                                                          data_sijs=data_sijs, 
+                                                                          query_sijs=sijs['query'], 
+                                                                          private_sijs=sijs['private'], 
+                                                                          magnificationEta=cfg['eta'],
+                                                                          privacyHardness=cfg['nu'])
+
+def _build_logdetcmi(n, num_queries, num_privates, sijs, cfg):
+    
+    return submodlib.LogDeterminantConditionalMutualInformationFunction(n=n,
+                                                                        num_queries=num_queries,
+                                                                        num_privates=num_privates, 
+                                                                        data_sijs=sijs['data'], 
+                                                                        query_sijs=sijs['query'], 
+                                                                        private_sijs=sijs['private'],
+                                                                        query_query_sijs=sijs['query_query'],
+                                                                        private_private_sijs=sijs['private_private'],
+                                                                        query_private_sijs=sijs['query_private'], 
+                                                                        magnificationEta=cfg['eta'],
+                                                                        privacyHardness=cfg['nu'],
+                                                                        lambdaVal=cfg['lambdaVal'])
+
+def _model_fingerprint(model):
+    """
+    Returns a cheap fingerprint of a model's parameters and buffers. It changes when a tensor is replaced or moved 
+    (new storage) and when it is modified by an in-place op that bumps the tensor's version counter. Writes made 
+    through tensor.data, as in older optimizers (e.g., SGD in torch 1.4) and EMA weight updates, do not bump it, so 
+    this is only a best-effort check; update_model() is the reliable way to invalidate anything keyed on it.
+    """
+    
+    return tuple((tensor.data_ptr(), tensor._version) for tensor in itertools.chain(model.parameters(), model.buffers()))
+
+# Builds the submodlib objective for each supported scmi_function from the kernels and the merged args
+_SCMI_BUILDERS = {'flcmi': _build_flcmi, 'logdetcmi': _build_logdetcmi}
+
 class SCMI(Strategy):
     
     """
@@ -31,6 +263,9 @@ class SCMI(Strategy):
     submodular functions. For more information-theoretic discussion, consider referring to the paper Submodular Combinatorial 
     Information Measures with Applications in Machine Learning :footcite:`iyer2021submodular`.
     
+    Query and private embeddings are cached across select() calls. After training the model in place, call update_model() 
+    so that they are recomputed; changes to the parameters are not guaranteed to be detected otherwise.
+    
     Parameters
     ----------
     labeled_dataset: torch.utils.data.Dataset
@@ -68,7 +303,19 @@ class SCMI(Strategy):
                 REQUIRED
             'optimizer': string
                 The optimizer to use for submodular maximization. Can be one of 'NaiveGreedy', 'StochasticGreedy', 
-                'LazyGreedy' and 'LazierThanLazyGreedy'. Default: 'NaiveGreedy'
+                'LazyGreedy' and 'LazierThanLazyGreedy'. Since the SCMI functions are submodular, 'LazyGreedy' returns 
+                the same selection as 'NaiveGreedy' up to ties while skipping most marginal gain re-evaluations. For 
+                'flcmi', these two optimizers both run a Numba-compiled lazy greedy instead of submodlib's maximize() when 
+                numba is installed; 'NaiveGreedy' then yields the same selection up to ties through lazy evaluation, and 
+                'verbose' has no effect. Default: 'LazyGreedy'
+            'auto_optimizer': bool
+                When True, 'LazierThanLazyGreedy' is used instead of 'optimizer' whenever the product of the unlabeled set 
+                size and the budget exceeds 5e7. Its n * ln(1 / epsilon) total oracle calls do not grow with the budget, 
+                at the cost of a (1 - 1/e - epsilon) approximation guarantee. It has no effect when the compiled FLCMI 
+                greedy is used, which is already exact and keeps a sparse kernel sparse. Default: False
+            'epsilon': float
+                The epsilon used by 'StochasticGreedy' and 'LazierThanLazyGreedy'. Each greedy step evaluates a random 
+                sample of n * ln(1 / epsilon) / budget candidates. Default: 0.1
             'metric': string
                 The similarity metric to use for similarity kernel computation. This can be either 'cosine' or 'euclidean'. 
                 Default: 'cosine'
@@ -78,6 +325,19 @@ class SCMI(Strategy):
                 Default: 1
             'nu': float
                 A parameter that governs the hardness of the privacy constraint. Default: 1.
+            'kernel_dtype': string
+                The precision used for the cosine similarity GEMM when kernels are computed on the GPU. This can be one of 
+                'float32', 'float16', or 'bfloat16'. Half precision doubles tensor-core throughput and is accurate enough 
+                for greedy selection; the resulting kernels are always float32. Default: 'float32'
+            'kernel_sparsity_k': int
+                When set and 'scmi_function' is 'flcmi', only the kernel_sparsity_k largest similarities of each unlabeled 
+                point to the other unlabeled points are kept, and the rest are treated as zero. Facility location only 
+                depends on the largest similarities of each point, so this approximation is usually mild. The kernel is 
+                built a block of rows at a time, avoiding a full dense kernel on the GPU and sklearn's float64 temporaries. 
+                The compiled FLCMI greedy consumes it in sparse form, in O(n * kernel_sparsity_k) memory; it is only expanded 
+                to a dense array when submodlib performs the maximization. Default: None (dense kernel)
+            'parallel_kernels': bool
+                Builds the independent similarity kernels concurrently on a thread pool. Default: True
             'embedding_type': string
                 The type of embedding to compute for similarity kernel computation. This can be either 'gradients' or 
                 'features'. Default: 'gradients'
@@ -98,6 +358,11 @@ class SCMI(Strategy):
                 Default: False
             'verbose': bool
                 Gives a more verbose output when calling select() when True. Default: False
+            'keep_embedding': bool
+                Stores the embeddings computed by select() as the unlabeled_data_embedding, query_embedding, and 
+                private_embedding attributes. They are kept as float16 tensors in host memory so that they do not pin 
+                device memory across rounds; call release_embeddings() to free them along with the cached query and 
+                private embeddings. Default: False
     """
     
     def __init__(self, labeled_dataset, unlabeled_dataset, query_dataset, private_dataset, net, nclasses, args={}): #
@@ -105,6 +370,41 @@ class SCMI(Strategy):
         super(SCMI, self).__init__(labeled_dataset, unlabeled_dataset, net, nclasses, args)        
         self.query_dataset = query_dataset
         self.private_dataset = private_dataset
+        
+        # Query and private embeddings, and the query-query, private-private, and query-private kernels built from them, 
+        # do not depend on the unlabeled set. They are kept across select() calls until update_queries(), update_privates(),
+        # update_model(), or release_embeddings() is called. Changes to the model's parameters are also detected on a best-effort basis only.
+        self._clear_caches()
+
+    def _clear_caches(self):
+        self._embedding_cache = {}
+        self._kernel_cache = {}
+
+    def update_queries(self, query_dataset):
+        super(SCMI, self).update_queries(query_dataset)
+        self._clear_caches()
+
+    def update_privates(self, private_dataset):
+        super(SCMI, self).update_privates(private_dataset)
+        self._clear_caches()
+
+    def update_model(self, clf):
+        super(SCMI, self).update_model(clf)
+        self._clear_caches()
+
+    def release_embeddings(self):
+        """
+        Frees the embeddings stored by select() when 'keep_embedding' is True, as well as the query and private 
+        embeddings and kernels that select() caches across rounds.
+        """
+        
+        self._release_kept_embeddings()
+        self._clear_caches()
+
+    def _release_kept_embeddings(self):
+        for name in ('unlabeled_data_embedding', 'query_embedding', 'private_embedding'):
+            if hasattr(self, name):
+                delattr(self, name)
 
     def select(self, budget):
         """
@@ -113,7 +413,9 @@ class SCMI(Strategy):
         Parameters
         ----------
         budget: int
-            Number of points to choose from the unlabeled dataset
+            Number of points to choose from the unlabeled dataset. If it is at least the size of the unlabeled dataset, every 
+            point is selected, unless 'stopIfZeroGain' or 'stopIfNegativeGain' is set; submodlib's maximize() then 
+            selects at most one fewer than the size of the unlabeled dataset.
         
         Returns
         ----------
@@ -121,74 +423,137 @@ class SCMI(Strategy):
             List of selected data point indices with respect to the unlabeled dataset
         """ 
 
-        #Get hyperparameters from args dict
-        optimizer = self.args['optimizer'] if 'optimizer' in self.args else 'NaiveGreedy'
-        metric = self.args['metric'] if 'metric' in self.args else 'cosine'
-        eta = self.args['eta'] if 'eta' in self.args else 1
-        nu = self.args['nu'] if 'nu' in self.args else 1
-        gradType = self.args['gradType'] if 'gradType' in self.args else "bias_linear"
-        stopIfZeroGain = self.args['stopIfZeroGain'] if 'stopIfZeroGain' in self.args else False
-        stopIfNegativeGain = self.args['stopIfNegativeGain'] if 'stopIfNegativeGain' in self.args else False
-        verbose = self.args['verbose'] if 'verbose' in self.args else False
-        embedding_type = self.args['embedding_type'] if 'embedding_type' in self.args else "gradients"
-        if(embedding_type=="features"):
-            layer_name = self.args['layer_name'] if 'layer_name' in self.args else "avgpool"
-        keep_embedding = self.args['keep_embedding'] if 'keep_embedding' in self.args else False
+        #Get hyperparameters from args dict, falling back to the defaults for any missing keys
+        cfg = {**_DEFAULT_ARGS, **self.args}
+        scmi_function = cfg['scmi_function']
+        optimizer = cfg['optimizer']
+        metric = cfg['metric']
+        gradType = cfg['gradType']
+        embedding_type = cfg['embedding_type']
+        layer_name = cfg['layer_name']
+        kernel_dtype = cfg['kernel_dtype']
+        kernel_sparsity_k = cfg['kernel_sparsity_k']
+        if(scmi_function not in _SCMI_BUILDERS):
+            raise ValueError("Provided scmi_function must be one of flcmi or logdetcmi")
+        if(kernel_dtype not in _KERNEL_DTYPES):
+            raise ValueError("Provided kernel dtype must be one of float32, float16, or bfloat16")
+        if(kernel_sparsity_k is not None and (not isinstance(kernel_sparsity_k, (int, np.integer)) or kernel_sparsity_k < 1)):
+            raise ValueError("Provided kernel_sparsity_k must be a positive integer")
+        if(budget < 0):
+            raise ValueError("Budget must be non-negative")
+
+        #Degenerate budgets need no embeddings, kernels, or maximization. When the budget covers the whole unlabeled set, 
+        #every point is selected unless the optimizer is allowed to stop early. No embeddings are computed on these paths, 
+        #so previously kept ones are dropped rather than left describing an earlier round.
+        n = len(self.unlabeled_dataset)
+        if(budget == 0 or (budget >= n and not cfg['stopIfZeroGain'] and not cfg['stopIfNegativeGain'])):
+            if(cfg['keep_embedding']):
+                self._release_kept_embeddings()
+            return list(range(min(budget, n)))
 
         #Compute Embeddings
         if(embedding_type == "gradients"):
             unlabeled_data_embedding = self.get_grad_embedding(self.unlabeled_dataset, True, gradType)
-            query_embedding = self.get_grad_embedding(self.query_dataset, False, gradType)
-            private_embedding = self.get_grad_embedding(self.private_dataset, False, gradType)
+            labeled_embedding = lambda dataset: self.get_grad_embedding(dataset, False, gradType)
         elif(embedding_type == "features"):
             unlabeled_data_embedding = self.get_feature_embedding(self.unlabeled_dataset, True, layer_name)
-            query_embedding = self.get_feature_embedding(self.query_dataset, False, layer_name)
-            private_embedding = self.get_feature_embedding(self.private_dataset, False, layer_name)
+            labeled_embedding = lambda dataset: self.get_feature_embedding(dataset, False, layer_name)
         else:
             raise ValueError("Provided representation must be one of gradients or features")
 
-        if(keep_embedding):
-            self.unlabeled_data_embedding = unlabeled_data_embedding
-            self.private_embedding = private_embedding
-            self.query_embedding = query_embedding
-
-        #Compute image-image kernel
-        data_sijs = submodlib.helper.create_kernel(X=unlabeled_data_embedding.cpu().numpy(), metric=metric, method="sklearn")
-        #Compute query-query kernel
-        if(self.args['scmi_function']=='logdetmi'):
-            query_query_sijs = submodlib.helper.create_kernel(X=query_embedding.cpu().numpy(), metric=metric, method="sklearn")
-            private_private_sijs = submodlib.helper.create_kernel(X=private_embedding.cpu().numpy(), metric=metric, method="sklearn")
-            query_private_sijs = submodlib.helper.create_kernel(X=private_embedding.cpu().numpy(), X_rep=query_embedding.cpu().numpy(), metric=metric, method="sklearn")
-        #Compute image-query kernel
-        query_sijs = submodlib.helper.create_kernel(X=query_embedding.cpu().numpy(), X_rep=unlabeled_data_embedding.cpu().numpy(), metric=metric, method="sklearn")
-        private_sijs = submodlib.helper.create_kernel(X=private_embedding.cpu().numpy(), X_rep=unlabeled_data_embedding.cpu().numpy(), metric=metric, method="sklearn")
+        #Reuse the query and private embeddings while the datasets and embedding configuration are unchanged and the model 
+        #fingerprint matches; the fingerprint misses writes through .data, so update_model() is what reliably invalidates 
+        #them. It is taken after the unlabeled pass, which has moved the model to its device. The cached embeddings are 
+        #held in host memory so that they do not pin device memory across rounds, and are moved to the device when used.
+        embedding_key = (_model_fingerprint(self.model), id(self.query_dataset), id(self.private_dataset), embedding_type, 
+                         layer_name if embedding_type == "features" else gradType)
+        if(embedding_key not in self._embedding_cache):
+            self._embedding_cache = {embedding_key: (labeled_embedding(self.query_dataset).detach().cpu(), 
+                                                     labeled_embedding(self.private_dataset).detach().cpu())}
+        query_embedding, private_embedding = (embedding.to(unlabeled_data_embedding.device) 
+                                              for embedding in self._embedding_cache[embedding_key])
+
+        if(cfg['keep_embedding']):
+            self.unlabeled_data_embedding = unlabeled_data_embedding.detach().half().cpu()
+            self.private_embedding = private_embedding.detach().half().cpu()
+            self.query_embedding = query_embedding.detach().half().cpu()
+
+        #Compute kernels on the device that holds the embeddings so that only the final kernels cross to host memory; 
+        #embeddings that already live in host memory use NumPy GEMMs for the dense kernels, and sklearn only for the 
+        #image-[Q;P] kernel of the sparse flcmi path. Embeddings are kept in float32 so that no kernel is promoted to 
+        #float64, which would double its memory and bandwidth.
+        if(unlabeled_data_embedding.is_cuda):
+            u_emb = unlabeled_data_embedding.detach().float()
+            q_emb = query_embedding.detach().float()
+            p_emb = private_embedding.detach().float()
+            all_emb = torch.cat([u_emb, q_emb, p_emb], dim=0)
+        else:
+            u_emb = unlabeled_data_embedding.detach().contiguous().cpu().numpy().astype(np.float32, copy=False)
+            q_emb = query_embedding.detach().contiguous().cpu().numpy().astype(np.float32, copy=False)
+            p_emb = private_embedding.detach().contiguous().cpu().numpy().astype(np.float32, copy=False)
+            all_emb = np.concatenate([u_emb, q_emb, p_emb], axis=0)
+
+        dtype = _KERNEL_DTYPES[kernel_dtype]
+
+        #Stack the embeddings once so that kernels sharing a side are computed in one pass
+        n = u_emb.shape[0]
+        num_queries = query_embedding.shape[0]
+        qp_emb = all_emb[n:]
+
+        #Collect the independent kernel computations so that they can run concurrently
+        kernel_builders = {}
+        qp_kernel_key = embedding_key + (metric, kernel_dtype)
+        if(scmi_function=='flcmi' and kernel_sparsity_k is not None):
+            #Compute image-image kernel, keeping only each point's nearest neighbors, and the image-query and 
+            #image-private kernels as column blocks of one kernel
+            kernel_builders['data'] = lambda: _create_sparse_kernel(X=u_emb, metric=metric, num_neighbors=kernel_sparsity_k, dtype=dtype)
+            kernel_builders['image_qp'] = lambda: _create_kernel(X=qp_emb, X_rep=u_emb, metric=metric, dtype=dtype)
+        else:
+            #Compute the image rows against all embeddings in one GEMM into a single float32 kernel and hand views of 
+            #it to submodlib. For logdetcmi, the query-query, private-private, and query-private kernels are blocks of a 
+            #separate query/private kernel unless cached; the private-query and query-image blocks are never needed, 
+            #so they are not allocated.
+            full_sijs = np.empty((n, all_emb.shape[0]), dtype=np.float32)
+            kernel_builders['image_all'] = lambda: _create_kernel(X=all_emb, X_rep=u_emb, metric=metric, dtype=dtype, out=full_sijs)
+            if(scmi_function=='logdetcmi'):
+                qp_sijs = self._kernel_cache.get(qp_kernel_key)
+                if(qp_sijs is None):
+                    qp_sijs = np.empty((qp_emb.shape[0], qp_emb.shape[0]), dtype=np.float32)
+                    kernel_builders['qp_qp'] = lambda: _create_kernel(X=qp_emb, metric=metric, dtype=dtype, out=qp_sijs)
         
-        if(self.args['scmi_function']=='flcmi'):
-            obj = submodlib.FacilityLocationConditionalMutualInformationFunction(n=unlabeled_data_embedding.shape[0],
-                                                                      num_queries=query_embedding.shape[0],
-                                                                      num_privates=private_embedding.shape[0], 
-                                                                      data_sijs=data_sijs, 
-                                                                      query_sijs=query_sijs, 
-                                                                      private_sijs=private_sijs, 
-                                                                      magnificationEta=eta,
-                                                                      privacyHardness=nu)
-    
-        if(self.args['scmi_function']=='logdetcmi'):
-            lambdaVal = self.args['lambdaVal'] if 'lambdaVal' in self.args else 1
-            obj = submodlib.LogDeterminantConditionalMutualInformationFunction(n=unlabeled_data_embedding.shape[0],
-                                                                      num_queries=query_embedding.shape[0],
-                                                                      num_privates=private_embedding.shape[0], 
-                                                                      data_sijs=data_sijs, 
-                                                                      query_sijs=query_sijs, 
-                                                                      private_sijs=private_sijs,
-                                                                      query_query_sijs=query_query_sijs,
-                                                                      private_private_sijs=private_private_sijs,
-                                                                      query_private_sijs=query_private_sijs, 
-                                                                      magnificationEta=eta,
-                                                                      privacyHardness=nu,
-                                                                      lambdaVal=lambdaVal)
-
-        greedyList = obj.maximize(budget=budget,optimizer=optimizer, stopIfZeroGain=stopIfZeroGain, 
-                              stopIfNegativeGain=stopIfNegativeGain, verbose=verbose)
+        kernels = _build_kernels(kernel_builders, parallel=cfg['parallel_kernels'])
+        if('data' in kernels):
+            sijs = {'data': kernels['data'], 
+                    'query': kernels['image_qp'][:, :num_queries], 
+                    'private': kernels['image_qp'][:, num_queries:]}
+        else:
+            sijs = {'data': full_sijs[:, :n], 
+                    'query': full_sijs[:, n:n + num_queries], 
+                    'private': full_sijs[:, n + num_queries:]}
+        if(scmi_function=='logdetcmi'):
+            #submodlib copies the kernels it is given, so the cached kernel is passed directly and never modified
+            if('qp_qp' in kernels):
+                self._kernel_cache = {qp_kernel_key: qp_sijs}
+            sijs['query_query'] = qp_sijs[:num_queries, :num_queries]
+            sijs['private_private'] = qp_sijs[num_queries:, num_queries:]
+            sijs['query_private'] = qp_sijs[:num_queries, num_queries:]
+        
+        #The compiled FLCMI greedy consumes the kernels directly, including sparse ones
+        use_flcmi_greedy = (scmi_function=='flcmi' and flcmi_greedy is not None and optimizer in ('NaiveGreedy', 'LazyGreedy'))
+
+        #For very large selections, trade the exact greedy for a stochastic one whose cost is independent of the budget. 
+        #The compiled FLCMI greedy is kept instead, since switching to submodlib would expand a sparse kernel to n x n.
+        if(cfg['auto_optimizer'] and not use_flcmi_greedy and unlabeled_data_embedding.shape[0] * budget > _AUTO_OPTIMIZER_THRESHOLD):
+            optimizer = 'LazierThanLazyGreedy'
+
+        if(use_flcmi_greedy):
+            greedyList = flcmi_greedy(sijs['data'], sijs['query'], sijs['private'], budget, eta=cfg['eta'], nu=cfg['nu'], 
+                                      stop_if_zero_gain=cfg['stopIfZeroGain'])
+        else:
+            obj = _SCMI_BUILDERS[scmi_function](unlabeled_data_embedding.shape[0], query_embedding.shape[0], 
+                                                private_embedding.shape[0], sijs, cfg)
+            #submodlib's maximize() requires the budget to be smaller than the ground set
+            greedyList = obj.maximize(budget=min(budget, n - 1),optimizer=optimizer, stopIfZeroGain=cfg['stopIfZeroGain'], 
+                                  stopIfNegativeGain=cfg['stopIfNegativeGain'], epsilon=cfg['epsilon'], verbose=cfg['verbose'])
         greedyIndices = [x[0] for x in greedyList]
         return greedyIndices
\ No newline at end of file
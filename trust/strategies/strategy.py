@@ -301,15 +301,33 @@ class Strategy:
 
     def get_feature_embedding(self, dataset, unlabeled, layer_name='avgpool'):
         dataloader = DataLoader(dataset, batch_size = self.args['batch_size'], shuffle = False)
-        features = []
-        if(unlabeled):
-            for batch_idx, inputs in enumerate(dataloader):
-                inputs = inputs.to(self.device)
-                batch_features = self.feature_extraction(inputs, layer_name)
-                features.append(batch_features)
-        else:
-            for batch_idx, (inputs,_) in enumerate(dataloader):
-                inputs = inputs.to(self.device)
-                batch_features = self.feature_extraction(inputs, layer_name)
-                features.append(batch_features)
-        return torch.vstack(features)
\ No newline at end of file
+        
+        # The embedding tensor is allocated once the feature shape is known from the first batch; 
+        # each batch is then written into its slice instead of being collected and concatenated.
+        features = None
+        evaluated_instances = 0
+        
+        for batch_idx, elements in enumerate(dataloader):
+            if(unlabeled):
+                inputs = elements
+            else:
+                inputs, _ = elements
+            inputs = inputs.to(self.device)
+            
+            # feature_extraction() squeezes away the batch dimension of single-element batches; restore it
+            batch_features = self.feature_extraction(inputs, layer_name)
+            if inputs.shape[0] == 1:
+                batch_features = batch_features.unsqueeze(0)
+            
+            if features is None:
+                features = torch.empty((len(dataset),) + tuple(batch_features.shape[1:]), dtype=batch_features.dtype, device=batch_features.device)
+            
+            start_slice = evaluated_instances
+            end_slice = start_slice + batch_features.shape[0]
+            features[start_slice:end_slice] = batch_features
+            evaluated_instances = end_slice
+        
+        if features is None:
+            raise ValueError("Cannot compute feature embeddings of an empty dataset")
+            
+        return features
\ No newline at end of file